@@ -1,16 +1,140 @@
 
 
 import streamlit as st
-import requests
-import xml.etree.ElementTree as ET
+import httpx
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lxml import etree
+import diskcache
 from datetime import datetime, timedelta, timezone
+import numpy as np
 import pandas as pd
 import io
+import queue
 import pydeck as pdk # pydeck をインポート
+try:
+    # C実装の高速なISO 8601パーサ（未インストールの場合は標準ライブラリを使用）
+    from ciso8601 import parse_datetime as _parse_datetime
+except ImportError:
+    _parse_datetime = datetime.fromisoformat # Python 3.11 以降は末尾の "Z" も解釈可能
 
 
 
 KISHOU_XML_PAGE_URL = "https://www.data.jma.go.jp/developer/xml/feed/extra_l.xml"
+WARNING_FEED_TITLE = "気象特別警報・警報・注意報" # 抽出対象のフィードタイトル
+FETCH_MAX_WORKERS = 16 # リンクXMLの並列取得数
+HTTP_CONNECT_RETRIES = 2 # 接続エラー時の再試行回数
+PIVOT_DISPLAY_MAX_ROWS = 500 # ピボットテーブルの画面表示行数の上限（CSVは全件）
+
+# Atomフィードのentry要素を取得するXPath（モジュール読み込み時に一度だけコンパイル）
+ATOM_ENTRY_XPATH = etree.XPath("atom:entry", namespaces={"atom": "http://www.w3.org/2005/Atom"})
+
+# entry内の要素パス（ループ内で毎回文字列を組み立てないよう定数化）
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+ATOM_ID_PATH = f"{ATOM_NS}id"
+ATOM_UPDATED_PATH = f"{ATOM_NS}updated"
+ATOM_TITLE_PATH = f"{ATOM_NS}title"
+ATOM_AUTHOR_NAME_PATH = f"{ATOM_NS}author/{ATOM_NS}name"
+ATOM_XML_LINK_PATH = f'{ATOM_NS}link[@type="application/xml"]'
+
+# 警報・注意報XMLの逐次パースで受け取る要素
+ITERPARSE_TAGS = ("{*}ReportDateTime", "{*}Text", "{*}Item")
+
+# 警報・注意報XMLの Item 内で使うXPath（名前空間に依存しないよう local-name() で指定）
+# smart_strings=False で、結果の文字列が解放済みの要素を参照し続けないようにする
+def _local_xpath(*names):
+    path = ".//" + "/".join(f'*[local-name()="{name}"]' for name in names) + "/text()"
+    return etree.XPath(path, smart_strings=False)
+
+KIND_NAME_XPATH = _local_xpath("Kind", "Name")
+AREAS_AREA_NAME_XPATH = _local_xpath("Areas", "Area", "Name")
+AREAS_AREA_CODE_XPATH = _local_xpath("Areas", "Area", "Code")
+PREFECTURE_NAME_XPATH = _local_xpath("Areas", "Area", "Prefecture", "Name")
+PREFECTURE_CODE_XPATH = _local_xpath("Areas", "Area", "Prefecture", "Code")
+AREA_NAME_XPATH = _local_xpath("Area", "Name")
+AREA_CODE_XPATH = _local_xpath("Area", "Code")
+
+# 接続を使い回すための共有HTTPクライアント（HTTP/2 で多数のリクエストを1本の接続に多重化）
+# brotli がインストールされていれば Accept-Encoding に br が自動で追加される
+# 並列取得中の一時的な接続失敗は transport 側で再試行する
+# httpx は既定ではリダイレクトを追わないため、requests と同様に追うよう指定する
+@st.cache_resource
+def _http_client():
+    limits = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+    return httpx.Client(
+        transport=httpx.HTTPTransport(http2=True, retries=HTTP_CONNECT_RETRIES, limits=limits),
+        timeout=15,
+        follow_redirects=True,
+    )
+
+# Atomフィードの前回レスポンス（URLキー）。ETag / Last-Modified を使って条件付きGETを行い、
+# 更新がなければ（304）本文をダウンロードせず前回の内容を使う
+@st.cache_resource
+def _feed_http_cache():
+    return {}
+
+# Atomフィードのパーサ。設定済みのパーサを使い回し、呼び出しごとの生成を省く
+# lxml のパーサは複数スレッドから同時に使えず、Streamlit は再実行ごとに別スレッドでスクリプトを動かすため、
+# st.cache_resource で保持したプールからパース1回分だけ取り出して使い、終わったら戻す
+@st.cache_resource
+def _feed_parser_pool():
+    return queue.SimpleQueue()
+
+def _parse_feed_xml(content: bytes):
+    pool = _feed_parser_pool()
+    try:
+        parser = pool.get_nowait()
+    except queue.Empty:
+        # 空白のみのテキストノードは作らず、外部エンティティ・ネットワークアクセスも行わない
+        parser = etree.XMLParser(remove_blank_text=True, resolve_entities=False, no_network=True)
+    try:
+        return etree.fromstring(content, parser)
+    finally:
+        pool.put(parser)
+
+# リンクXMLのローカルキャッシュ（URLキー）。st.cache_data をクリアしても残る
+XML_CACHE_DIR = ".xml_cache"
+XML_CACHE_EXPIRE_SECONDS = 7 * 24 * 3600 # 7日
+WARNINGS_CACHE_VERSION = 2 # extract_warnings の出力が変わったら上げて、パース結果のキャッシュを無効化する
+
+@st.cache_resource
+def _xml_cache():
+    # SQLite を使うキャッシュを再実行のたびに開き直さないよう、1つのインスタンスを共有する
+    return diskcache.Cache(XML_CACHE_DIR)
+
+# 緯度・経度マッピング辞書（簡易版：主要都道府県・地域）。値は変更しない (緯度, 経度) のタプル
+AREA_LAT_LON_MAP = {
+    "北海道": (43.06, 141.35), "札幌": (43.06, 141.35), "青森県": (40.82, 140.74),
+    "岩手県": (39.70, 141.15), "宮城県": (38.27, 140.87), "仙台": (38.27, 140.87),
+    "秋田県": (39.72, 140.10), "山形県": (38.24, 140.36), "福島県": (37.75, 140.47),
+    "茨城県": (36.34, 140.45), "栃木県": (36.57, 139.88), "群馬県": (36.39, 139.06),
+    "埼玉県": (35.86, 139.65), "千葉県": (35.61, 140.12), "東京都": (35.69, 139.69),
+    "千代田区": (35.69, 139.75), "伊豆諸島北部": (34.74, 139.40), "伊豆諸島南部": (33.11, 139.79),
+    "小笠原諸島": (26.65, 142.20), "神奈川県": (35.45, 139.64), "横浜": (35.45, 139.64),
+    "新潟県": (37.90, 139.02), "富山県": (36.70, 137.21), "石川県": (36.59, 136.63),
+    "福井県": (36.07, 136.22), "山梨県": (35.66, 138.57), "長野県": (36.65, 138.18),
+    "岐阜県": (35.42, 136.72), "静岡県": (34.98, 138.38), "愛知県": (35.18, 136.91),
+    "名古屋": (35.18, 136.91), "三重県": (34.73, 136.51), "滋賀県": (35.00, 135.87),
+    "京都府": (35.02, 135.76), "大阪府": (34.69, 135.50), "兵庫県": (34.69, 135.18),
+    "奈良県": (34.69, 135.83), "和歌山県": (34.23, 135.17), "鳥取県": (35.50, 134.24),
+    "島根県": (35.47, 133.05), "岡山県": (34.66, 133.93), "広島県": (34.40, 132.46),
+    "山口県": (34.19, 131.47), "徳島県": (34.07, 134.56), "香川県": (34.34, 134.04),
+    "愛媛県": (33.84, 132.77), "高知県": (33.56, 133.53), "福岡県": (33.61, 130.40),
+    "佐賀県": (33.26, 130.30), "長崎県": (32.75, 129.88), "熊本県": (32.80, 130.71),
+    "大分県": (33.24, 131.61), "宮崎県": (31.91, 131.42), "鹿児島県": (31.56, 130.56),
+    "沖縄県": (26.21, 127.68), "沖縄本島地方": (26.21, 127.68), "宮古島地方": (24.80, 125.28),
+    "八重山地方": (24.34, 124.16)
+    # ... 他の市町村コードを追加可能 ...
+}
+# 地図の色（RGBA）: 特別警報・警報・注意報・その他 の順
+KIND_COLORS = np.array([
+    [255, 0, 255, 180], # 紫 (不透明度追加)
+    [255, 0, 0, 180], # 赤
+    [255, 255, 0, 180], # 黄
+    [128, 128, 128, 180], # グレー
+], dtype=np.uint8)
+
+# 地域名をインデックスとした緯度・経度の表（地図用データとの結合に使用）
+AREA_DF = pd.DataFrame.from_dict(AREA_LAT_LON_MAP, orient="index", columns=["lat", "lon"])
 
 st.set_page_config(page_title="気象庁 防災情報XML（長期フィード）「気象特別警報・警報・注意報」発表履歴検索ツール", layout="wide")
 
@@ -32,197 +156,333 @@ with st.expander("📘 気象庁防災情報XMLとは？", expanded=True):
     
     """)
 
+def _parse_iso(time_str):
+    """
+    ISO 8601 形式の時刻文字列をタイムゾーン付きの datetime に変換します。
+    パースできない場合は None を返します（タイムゾーンなしの場合はUTCとみなします）。
+    """
+    if not time_str or time_str == "N/A":
+        return None
+    try:
+        parsed_time = _parse_datetime(time_str)
+    except ValueError:
+        return None
+    if parsed_time.tzinfo is None:
+        parsed_time = parsed_time.replace(tzinfo=timezone.utc)
+    return parsed_time
+
+def extract_warnings(source):
+    """
+    警報・注意報XMLを読み込みながら逐次パースし、(ReportDateTime または None, 警報・注意報のリスト, パース成否) を返します。
+    source は read() を持つバイト列のファイル風オブジェクトです。
+    XMLが不正な場合は「解析エラー」の行を返し、パース成否は False になります（呼び出し側でキャッシュしないため）。
+    """
+    report_dt = None
+    warnings = []
+    parsed_ok = True
+    try:
+        report_dt_found = False
+        overall_detail = None
+        # 逐次パース: Item ごとに処理し、処理済みの要素は解放してメモリ使用量を抑える
+        # tag で必要な要素だけに絞り、それ以外の要素のイベントは lxml 側（C）で読み飛ばす
+        for _, elem in etree.iterparse(source, events=("end",), tag=ITERPARSE_TAGS):
+            tag = elem.tag.rpartition("}")[2]
+
+            # XML内の最初のReportDateTimeを取得
+            if tag == "ReportDateTime":
+                if not report_dt_found:
+                    report_dt_found = True
+                    if elem.text:
+                        report_dt = elem.text
+                continue
+
+            # ヘッドライン（概要）を取得
+            if tag == "Text":
+                parent = elem.getparent()
+                # 名前空間の有無に関わらずローカル名で比較（{*}Headline/{*}Text と同じ判定）
+                if overall_detail is None and parent is not None and parent.tag.rpartition("}")[2] == "Headline":
+                    overall_detail = elem.text or "N/A"
+                continue
+
+            # 各警報・注意報アイテムをパース
+            item = elem
+            if overall_detail is None:
+                overall_detail = "N/A"
+            # XPathはテキストのリストを直接返すため、.text参照やNoneチェックが不要
+            kind = (KIND_NAME_XPATH(item) or ["N/A"])[0]
+
+            area_names = AREAS_AREA_NAME_XPATH(item)
+            area_codes = AREAS_AREA_CODE_XPATH(item)
+            if not area_names:
+                area_names = PREFECTURE_NAME_XPATH(item)
+                area_codes = PREFECTURE_CODE_XPATH(item)
+            if not area_names:
+                # Colabの <Area> 直下検索ロジック
+                area_names = AREA_NAME_XPATH(item)
+                area_codes = AREA_CODE_XPATH(item)
+
+            if area_names:
+                area = area_names[0]
+                area_code = area_codes[0] if area_codes else "N/A"
+            elif area_codes: # Area名がなくCodeだけある場合
+                area_code = area_codes[0]
+                area = f"コード:{area_code}" # Colabのフォールバック
+            else:
+                area = "N/A"
+                area_code = "N/A"
+
+            if kind != "N/A" or area != "N/A" or area_code != "N/A":
+                warnings.append({"Kind": kind, "Area": area, "AreaCode": area_code, "Detail": overall_detail})
+            else:
+                warnings.append({"Kind": "不明な種類", "Area": "不明な地域", "AreaCode": "N/A", "Detail": overall_detail})
+
+            # 処理済みのItemと、それより前の兄弟要素を解放
+            item.clear()
+            while item.getprevious() is not None:
+                del item.getparent()[0]
+
+    except etree.XMLSyntaxError:
+        report_dt = None
+        warnings = [{"Kind": "解析エラー", "Area": "解析エラー", "AreaCode": "解析エラー", "Detail": "XML解析エラー"}] # 途中までの結果は破棄
+        parsed_ok = False
+    return report_dt, warnings, parsed_ok
+
+class _TeeReader:
+    """
+    受信したチャンクを記録しながら read() で読み出せるファイル風オブジェクトです。
+    受信中のXMLをパーサに直接渡しつつ、ローカルキャッシュ用にも保持するために使います。
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray() # 未読分のみを保持（読み出した分は先頭から削除）
+        self.received = []
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self.received.append(chunk)
+            self._buffer += chunk
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def getvalue(self):
+        return b"".join(self.received)
+
+def fetch_linked_xml(linked_xml_url: str, client: httpx.Client, cache: diskcache.Cache):
+    """
+    リンクされた警報・注意報XMLを取得し、受信しながら extract_warnings でパースした結果を返します。
+    並列取得のワーカースレッドから呼ばれるため、client と cache は呼び出し元（スクリプトのスレッド）で取得して渡します。
+    公開済みのXMLは内容が変わらないため、URLをキーにローカルキャッシュを優先します。
+    XMLのバイト列とパース結果はローカルキャッシュにのみ保存し、バイト列は呼び出し元には返しません。
+    パースに失敗したXMLはキャッシュせず、次回の更新時に再ダウンロードします。
+    """
+    # パース済みの結果があれば、XMLの読み込みもパースも行わない
+    parsed_key = ("warnings", WARNINGS_CACHE_VERSION, linked_xml_url)
+    parsed = cache.get(parsed_key)
+    if parsed is not None:
+        return parsed
+
+    parsed_ok = False
+    cached = cache.get(linked_xml_url)
+    if cached is not None:
+        report_dt, warnings, parsed_ok = extract_warnings(io.BytesIO(cached))
+    if not parsed_ok:
+        # ストリーミングでレスポンス本体をバッファせず、受信しながらパーサに渡す（gzip/br は展開済み）
+        with client.stream("GET", linked_xml_url) as lx_resp:
+            lx_resp.raise_for_status()
+            reader = _TeeReader(lx_resp.iter_bytes())
+            report_dt, warnings, parsed_ok = extract_warnings(reader)
+            reader.read() # パーサが読み残した分も読み切ってキャッシュに含める
+            content = reader.getvalue()
+        if parsed_ok:
+            cache.set(linked_xml_url, content, expire=XML_CACHE_EXPIRE_SECONDS)
+
+    parsed = (report_dt, warnings)
+    if parsed_ok:
+        cache.set(parsed_key, parsed, expire=XML_CACHE_EXPIRE_SECONDS)
+    return parsed
+
 @st.cache_data(ttl=600)
-def fetch_feed(url: str, hours_threshold: int = 48):
+def fetch_feed(url: str, hours_threshold: int = 48, target_title: str = WARNING_FEED_TITLE):
     """
     指定されたURLからAtomフィードを取得し、リンクされているXMLデータを（指定時間内のエントリーのみ）取得します。
+    リンクXMLをダウンロードするのはタイトルが target_title のエントリーのみで、それ以外はフィードの情報だけを残します。
+    警報・注意報のXMLは取得時にパースし、メモリ（st.cache_data）にはXML本体ではなくパース結果のみを保持します。
     """
     fetched = {"main_feed_xml": None, "linked_entries_xml": []}
     time_threshold = datetime.now(timezone.utc) - timedelta(hours=hours_threshold)
 
     try:
-        resp = requests.get(url, timeout=15)
-        resp.raise_for_status()
-        fetched["main_feed_xml"] = resp.content
+        previous = _feed_http_cache().get(url)
+        headers = {}
+        if previous is not None:
+            if previous["etag"]:
+                headers["If-None-Match"] = previous["etag"]
+            if previous["last_modified"]:
+                headers["If-Modified-Since"] = previous["last_modified"]
+
+        resp = _http_client().get(url, headers=headers)
+        if resp.status_code == httpx.codes.NOT_MODIFIED and previous is not None:
+            fetched["main_feed_xml"] = previous["content"]
+        else:
+            resp.raise_for_status()
+            fetched["main_feed_xml"] = resp.content
+            _feed_http_cache()[url] = {
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "content": resp.content,
+            }
+
+        root = _parse_feed_xml(fetched["main_feed_xml"])
+        to_fetch = [] # (linked_entries_xml 内のインデックス, URL)
 
-        root = ET.fromstring(fetched["main_feed_xml"].decode("utf-8"))
-        atom_ns = "{http://www.w3.org/2005/Atom}"
+        for entry in ATOM_ENTRY_XPATH(root):
+            # 更新時刻を先に確認し、しきい値より古いエントリーは辞書を作らずにスキップ
+            # （時刻のパースに失敗した場合はスキップしない）
+            # findtext は要素の検索とテキスト取得を1回の呼び出しで行う（要素がない・空の場合は "N/A"）
+            feed_report_time_str = entry.findtext(ATOM_UPDATED_PATH) or "N/A"
+            feed_report_time = _parse_iso(feed_report_time_str)
+            if feed_report_time is not None and feed_report_time < time_threshold:
+                continue
 
-        for entry in root.findall(f"{atom_ns}entry"):
             entry_info = {
-                "EntryID": entry.find(f"{atom_ns}id").text if entry.find(f"{atom_ns}id") is not None else "N/A",
-                "FeedReportDateTime": entry.find(f"{atom_ns}updated").text if entry.find(f"{atom_ns}updated") is not None else "N/A",
-                "FeedTitle": entry.find(f"{atom_ns}title").text if entry.find(f"{atom_ns}title") is not None else "N/A",
-                "Author": entry.find(f"{atom_ns}author/{atom_ns}name").text if entry.find(f"{atom_ns}author/{atom_ns}name") is not None else "N/A",
-                "LinkedXMLData": None,
+                "EntryID": entry.findtext(ATOM_ID_PATH) or "N/A",
+                "FeedReportDateTime": feed_report_time_str,
+                "FeedTitle": entry.findtext(ATOM_TITLE_PATH) or "N/A",
+                "Author": entry.findtext(ATOM_AUTHOR_NAME_PATH) or "N/A",
                 "LinkedXMLUrl": None
             }
 
-            feed_report_time_str = entry_info.get("FeedReportDateTime")
-            skip_by_time = False
-            if feed_report_time_str and feed_report_time_str != "N/A":
-                try:
-                    # タイムゾーン情報を正しく処理
-                    if feed_report_time_str.endswith("Z"):
-                        feed_report_time = datetime.fromisoformat(feed_report_time_str[:-1]).replace(tzinfo=timezone.utc)
-                    else:
-                        feed_report_time = datetime.fromisoformat(feed_report_time_str)
-                    
-                    # 取得した時間がしきい値より古い場合はスキップ
-                    if feed_report_time < time_threshold:
-                        skip_by_time = True
-                except Exception:
-                    pass # 時刻のパースに失敗した場合はスキップしない（次の処理で試行）
-
-            linked_xml_link_element = entry.find(f'{atom_ns}link[@type="application/xml"]')
-            # 時間でスキップフラグが立っておらず、リンク要素が存在する場合のみXMLを取得
-            if linked_xml_link_element is not None and not skip_by_time:
-                linked_xml_url = linked_xml_link_element.get("href")
-                if linked_xml_url:
-                    try:
-                        lx_resp = requests.get(linked_xml_url, timeout=15)
-                        lx_resp.raise_for_status()
-                        entry_info["LinkedXMLData"] = lx_resp.content
-                        entry_info["LinkedXMLUrl"] = linked_xml_url
-                    except Exception as e:
-                        entry_info["LinkedXMLData"] = None
-                        entry_info["LinkedXMLError"] = str(e)
+            linked_xml_link_element = entry.find(ATOM_XML_LINK_PATH)
+            # リンク要素が存在し、対象タイトルのエントリーのみ取得対象に追加（タイトルはフィードから分かるため、対象外はダウンロードしない）
+            if linked_xml_link_element is not None:
+                entry_info["LinkedXMLUrl"] = linked_xml_link_element.get("href")
+                if entry_info["LinkedXMLUrl"] and entry_info["FeedTitle"] == target_title:
+                    to_fetch.append((len(fetched["linked_entries_xml"]), entry_info["LinkedXMLUrl"]))
             fetched["linked_entries_xml"].append(entry_info)
 
+        # リンクXMLをまとめて並列取得し、受信しながらパース（エラーはエントリーごとに記録）
+        # st.cache_resource の共有リソースはワーカースレッドではなく、ここ（スクリプトのスレッド）で取得して渡す
+        client = _http_client()
+        cache = _xml_cache()
+        with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as ex:
+            futures = {ex.submit(fetch_linked_xml, linked_xml_url, client, cache): i for i, linked_xml_url in to_fetch}
+            for fut in as_completed(futures):
+                entry_info = fetched["linked_entries_xml"][futures[fut]]
+                try:
+                    entry_info["ReportDateTime"], entry_info["WarningsAdvisories"] = fut.result()
+                except Exception as e:
+                    entry_info["LinkedXMLError"] = str(e)
+
     except Exception as e:
         fetched["error"] = str(e)
 
     return fetched
 
-def parse_warnings_advisories(fetched_data, hours_threshold: int = 48):
+def parse_warnings_entry(entry, time_threshold, target_title: str = WARNING_FEED_TITLE):
+    """
+    fetch_feedの1エントリー分から target_title（既定は「気象特別警報・警報・注意報」）の情報をまとめます。
+    リンクXMLは fetch_feed で受信時にパース済みのため、ここでは結果を整形するだけです。
+    """
+    feed_title = entry.get("FeedTitle", "N/A")
+    # 対象タイトル（fetch_feed でリンクXMLを取得したもの）以外はスキップ
+    if feed_title != target_title:
+        return None
+
+    # fetch_feedで時間フィルタリングしているが、念のためここでも確認
+    feed_time = _parse_iso(entry.get("FeedReportDateTime"))
+    if feed_time and feed_time < time_threshold:
+        return None
+
+    extracted = {
+        "EntryID": entry.get("EntryID", "N/A"),
+        "FeedReportDateTime": entry.get("FeedReportDateTime", "N/A"),
+        "FeedTitle": feed_title,
+        "Author": entry.get("Author", "N/A"),
+        "LinkedXMLDataPresent": "WarningsAdvisories" in entry, # 取得・パースに成功した場合のみ設定される
+        "LinkedXMLUrl": entry.get("LinkedXMLUrl", "")
+    }
+
+    report_dt = entry.get("ReportDateTime") or extracted["FeedReportDateTime"] # XML内の日時がなければフィードの日時
+
+    if extracted["LinkedXMLDataPresent"]:
+        warnings = entry.get("WarningsAdvisories", [])
+    else:
+        # リンクされたXMLデータがない場合 (fetch_feedでスキップされた場合など)
+        if entry.get("LinkedXMLError"):
+             warnings = [{"Kind": "取得エラー", "Area": "取得エラー", "AreaCode": "取得エラー", "Detail": entry.get("LinkedXMLError")}]
+        else:
+             warnings = [{"Kind": "データなし", "Area": "データなし", "AreaCode": "データなし", "Detail": "時間外または取得対象外"}]
+
+
+    # パースした警報情報があり、かつ元データが存在した場合のみリストに追加
+    if warnings and extracted["LinkedXMLDataPresent"]:
+        extracted["ReportDateTime"] = report_dt # XML内の日時で更新
+        extracted["WarningsAdvisories"] = warnings
+        return extracted
+    return None
+
+def parse_warnings_advisories(fetched_data, hours_threshold: int = 48, target_title: str = WARNING_FEED_TITLE):
     """
-    fetch_feedから取得したデータのうち、「気象特別警報・警報・注意報」のみをパースします。
+    fetch_feedから取得したデータのうち、target_title（既定は「気象特別警報・警報・注意報」）のみをパースします。
+    target_title は fetch_feed に渡したものと同じ値を指定します。
     (Colab ステップ2 のロジックを反映)
+    XMLは fetch_feed でパース済みで、ここでは絞り込みと整形のみのため、キャッシュせずに毎回実行します。
     """
-    parsed = []
     if not fetched_data or not fetched_data.get("linked_entries_xml"):
-        return parsed
+        return []
 
+    parsed = []
     time_threshold = datetime.now(timezone.utc) - timedelta(hours=hours_threshold)
 
     for entry in fetched_data["linked_entries_xml"]:
-        feed_title = entry.get("FeedTitle", "N/A")
-        # 「気象特別警報・警報・注意報」以外はスキップ
-        if feed_title != "気象特別警報・警報・注意報":
-            continue
-
-        # fetch_feedで時間フィルタリングしているが、念のためここでも確認
-        feed_time_str = entry.get("FeedReportDateTime")
-        try:
-            if feed_time_str and feed_time_str.endswith("Z"):
-                feed_time = datetime.fromisoformat(feed_time_str[:-1]).replace(tzinfo=timezone.utc)
-            elif feed_time_str:
-                feed_time = datetime.fromisoformat(feed_time_str)
-            else:
-                feed_time = None
-        except Exception:
-            feed_time = None
-
-        if feed_time and feed_time < time_threshold:
-            continue
-
-        extracted = {
-            "EntryID": entry.get("EntryID", "N/A"),
-            "FeedReportDateTime": entry.get("FeedReportDateTime", "N/A"),
-            "FeedTitle": feed_title,
-            "Author": entry.get("Author", "N/A"),
-            "LinkedXMLDataPresent": bool(entry.get("LinkedXMLData")),
-            "LinkedXMLUrl": entry.get("LinkedXMLUrl", "")
-        }
-
-        linked_bytes = entry.get("LinkedXMLData")
-        warnings = []
-        report_dt = extracted["FeedReportDateTime"] # デフォルト値
-
-        if linked_bytes:
-            try:
-                xml_text = linked_bytes.decode("utf-8")
-            except Exception:
-                xml_text = linked_bytes.decode("utf-8", errors="replace") # デコードエラー時は置換
-            try:
-                root = ET.fromstring(xml_text)
-                # XML内のReportDateTimeを取得
-                rt = root.find('.//{*}ReportDateTime')
-                if rt is not None and rt.text:
-                    report_dt = rt.text
-
-                # ヘッドライン（概要）を取得
-                headline = root.find('.//{*}Headline/{*}Text')
-                overall_detail = headline.text if headline is not None and headline.text else "N/A"
-
-                # 各警報・注意報アイテムをパース
-                items = root.findall('.//{*}Item')
-                if not items:
-                    items = root.findall('.//{*}Headline//{*}Item') # Colabで追加されたパス
-
-                for item in items:
-                    kind = "N/A"
-                    area = "N/A"
-                    area_code = "N/A"
-
-                    kind_el = item.find('.//{*}Kind/{*}Name')
-                    kind = kind_el.text if kind_el is not None and kind_el.text else "N/A"
-
-                    area_el = item.find('.//{*}Areas/{*}Area/{*}Name')
-                    area_code_el = item.find('.//{*}Areas/{*}Area/{*}Code')
-                    
-                    if area_el is not None:
-                        area = area_el.text
-                        area_code = area_code_el.text if area_code_el is not None else "N/A"
-                    else:
-                        area_el = item.find('.//{*}Areas/{*}Area/{*}Prefecture/{*}Name')
-                        area_code_el = item.find('.//{*}Areas/{*}Area/{*}Prefecture/{*}Code')
-                        if area_el is not None:
-                            area = area_el.text
-                            area_code = area_code_el.text if area_code_el is not None else "N/A"
-                        else:
-                            # Colabの <Area> 直下検索ロジック
-                            area_el = item.find('.//{*}Area/{*}Name')
-                            area_code_el = item.find('.//{*}Area/{*}Code')
-                            if area_el is not None:
-                                area = area_el.text
-                                area_code = area_code_el.text if area_code_el is not None else "N/A"
-                            elif area_code_el is not None: # Area名がなくCodeだけある場合
-                                area_code = area_code_el.text
-                                area = f"コード:{area_code}" # Colabのフォールバック
-                            else:
-                                area = "N/A"
-                                area_code = "N/A"
-
-                    if kind != "N/A" or area != "N/A" or area_code != "N/A":
-                        warnings.append({"Kind": kind, "Area": area, "AreaCode": area_code, "Detail": overall_detail})
-                    elif item is not None:
-                        warnings.append({"Kind": "不明な種類", "Area": "不明な地域", "AreaCode": "N/A", "Detail": overall_detail})
-
-            except ET.ParseError:
-                warnings.append({"Kind": "解析エラー", "Area": "解析エラー", "AreaCode": "解析エラー", "Detail": "XML解析エラー"})
-            except Exception as e:
-                st.error(f"XML解析中に予期せぬエラー: {e}")
-                warnings.append({"Kind": "エラー", "Area": "エラー", "AreaCode": "エラー", "Detail": "不明なエラー"})
-        else:
-            # リンクされたXMLデータがない場合 (fetch_feedでスキップされた場合など)
-            if entry.get("LinkedXMLError"):
-                 warnings.append({"Kind": "取得エラー", "Area": "取得エラー", "AreaCode": "取得エラー", "Detail": entry.get("LinkedXMLError")})
-            elif not extracted["LinkedXMLDataPresent"]:
-                 warnings.append({"Kind": "データなし", "Area": "データなし", "AreaCode": "データなし", "Detail": "時間外または取得対象外"})
-            else:
-                 warnings.append({"Kind": "取得失敗", "Area": "取得失敗", "AreaCode": "取得失敗", "Detail": "リンクXMLがありません"})
-
-
-        # パースした警報情報があり、かつ元データが存在した場合のみリストに追加
-        if warnings and extracted["LinkedXMLDataPresent"]:
-            extracted["ReportDateTime"] = report_dt # XML内の日時で更新
-            extracted["WarningsAdvisories"] = warnings
+        extracted = parse_warnings_entry(entry, time_threshold, target_title)
+        if extracted:
             parsed.append(extracted)
 
     return parsed
 
 
+@st.cache_data(ttl=600)
+def to_report_date(report_datetime: pd.Series) -> pd.Series:
+    """
+    ReportDateTime の列を日付（UTC基準）のみの Series 'ReportDate' に変換します。
+    変換できない値は欠損になります。dfが変わらない限り、再実行時はキャッシュを返します。
+    """
+    # utc=True でタイムゾーンの混在も一括でUTCに正規化し、format='ISO8601' でC実装の高速パーサを使用
+    report_datetime_utc = pd.to_datetime(report_datetime, utc=True, errors='coerce', format='ISO8601')
+    return report_datetime_utc.dt.tz_convert(None).dt.date.rename('ReportDate') # タイムゾーン削除後、日付のみ取得
+
+@st.cache_data(ttl=600)
+def build_manual_pivot(df: pd.DataFrame, report_date: pd.Series, index_cols: list) -> pd.DataFrame:
+    """
+    ReportDate と index_cols の組み合わせごとに Kind の件数を集計したピボットテーブルを返します。
+    地図の操作などによる再実行では、df が同じであればキャッシュを返します。
+    キャッシュのキーは引数全体のハッシュのため、df には index_cols と Kind の列だけを渡します。
+    """
+    # 整数コードでグループ化する（カテゴリ型に変換済みの列はそのまま使われる）
+    group_keys = [report_date] + [df[col].astype('category') for col in index_cols + ['Kind']]
+
+    # Colab ステップ5 の groupby().size().unstack() を使用
+    # observed=True で、実際に出現した組み合わせのみを集計（カテゴリの直積を作らない）
+    return df.groupby(group_keys, observed=True).size().unstack(fill_value=0)
+
+@st.cache_data(ttl=600, max_entries=16, show_spinner=False)
+def _csv_bytes(df: pd.DataFrame, index: bool = False) -> bytes:
+    """
+    DataFrame をダウンロード用のCSV（BOM付きUTF-8）のバイト列に変換します。
+    df が同じであれば、再実行時は変換し直さずキャッシュしたバイト列を返します。
+    """
+    csv_buffer = io.BytesIO() # バイト列に直接書き出し、文字列→再エンコードの二重コピーを避ける
+    df.to_csv(csv_buffer, index=index, encoding="utf-8-sig", lineterminator="\n")
+    return csv_buffer.getvalue()
+
+
 # --- ▼▼▼ サイドバーへの移動 ▼▼▼ ---
 st.sidebar.markdown("### 設定")
 hours = st.sidebar.number_input("何時間以内のフィードを取得しますか？", min_value=1, max_value=168, value=48, step=1)
@@ -230,91 +490,82 @@ if st.sidebar.button("フィード取得 / 更新"):
     # キャッシュをクリアして再実行
     st.cache_data.clear()
     st.rerun()
+if st.sidebar.button("ローカルキャッシュをクリア"):
+    # 取得済みのリンクXML・Atomフィードも破棄して、次回はすべて再ダウンロード
+    _xml_cache().clear()
+    _feed_http_cache().clear()
+    st.cache_data.clear()
+    st.rerun()
 # --- ▲▲▲ サイドバーへの移動 ▲▲▲ ---
 
 
 # --- ▼▼▼ メイン画面（旧col2） ▼▼▼ ---
 st.markdown("### フィード取得状況")
 with st.spinner("フィードを取得しています..."):
-    data = fetch_feed(KISHOU_XML_PAGE_URL, hours_threshold=hours)
+    data = fetch_feed(KISHOU_XML_PAGE_URL, hours_threshold=hours, target_title=WARNING_FEED_TITLE)
 # --- ▲▲▲ メイン画面（旧col2） ▲▲▲ ---
 
 if data.get("error"):
     st.error(f"取得中にエラーが発生しました: {data['error']}")
 
 entries = data.get("linked_entries_xml", [])
-st.markdown(f"**フィード内エントリー数**: {len(entries)} （うち、{hours}時間以内のXML取得対象エントリーのみ処理）")
+st.markdown(f"**フィード内エントリー数**: {len(entries)} （{hours}時間以内に更新されたエントリーのみ）")
 
 # Atom フィードの CSV ダウンロード機能
 if entries:
     atom_feed_df = pd.DataFrame(entries)
-    # LinkedXMLData列は重いのでCSVからは削除
-    if "LinkedXMLData" in atom_feed_df.columns:
-        atom_feed_df = atom_feed_df.drop(columns=["LinkedXMLData"])
+    # リンクXMLから取得した列（ReportDateTime・WarningsAdvisories）は警報・注意報CSVに含まれるためCSVからは削除
+    atom_feed_df = atom_feed_df.drop(columns=["ReportDateTime", "WarningsAdvisories"], errors="ignore")
         
-    csv_buffer_atom = io.StringIO()
-    atom_feed_df.to_csv(csv_buffer_atom, index=False, encoding="utf-8-sig")
     st.download_button(
         label="Atom フィードを CSV でダウンロード",
-        data=csv_buffer_atom.getvalue().encode("utf-8-sig"),  # BOM付きUTF-8
+        data=_csv_bytes(atom_feed_df),  # BOM付きUTF-8
         file_name=f"atom_feed_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv",
         mime="text/csv"
     )
 
 # --- 警報・注意報データの処理 ---
-parsed = parse_warnings_advisories(data, hours_threshold=hours)
+parsed = parse_warnings_advisories(data, hours_threshold=hours, target_title=WARNING_FEED_TITLE)
 
 if parsed:
-    transformed_data_for_db = []
-    count_placeholder = st.empty()  # カウントアップ用のプレースホルダー
-    count = 0
+    count_placeholder = st.empty()  # 件数表示用のプレースホルダー
     # (Colab ステップ4 のロジックを反映)
+    # 行ごとにUIを更新せず、列ごとのリストに値を集めてから一度にDataFrameを構築
+    # (Colab ステップ4 の列名変更・列順序もここで反映し、rename や列の並べ替えによるコピーを省く)
+    columns = {
+        "ReportDateTime": [],
+        "Title": [],
+        "Author": [],
+        "「AreaForecastLocalM」コード": [], # AreaCode を追加
+        "気象情報／府県予報区・細分区域等": [],
+        "Kind": [],
+        "Detail": [],
+        "EntryID": [],
+    }
     for p in parsed:
-        for wa in p.get("WarningsAdvisories", []):
-            transformed_data_for_db.append({
-                "ReportDateTime": p.get("ReportDateTime"),
-                "Title": p.get("FeedTitle"),
-                "Author": p.get("Author"),
-                "AreaCode": wa.get("AreaCode"), # AreaCode を追加
-                "Area": wa.get("Area"),
-                "Kind": wa.get("Kind"),
-                "Detail": wa.get("Detail"),
-                "EntryID": p.get("EntryID")
-            })
-            count += 1
-            count_placeholder.info(f"{count} 件の警報・注意報データを読み込み中...")  # 同じ枠内で更新
+        warnings_advisories = p.get("WarningsAdvisories", [])
+        n = len(warnings_advisories)
+        columns["ReportDateTime"].extend([p.get("ReportDateTime")] * n)
+        columns["Title"].extend([p.get("FeedTitle")] * n)
+        columns["Author"].extend([p.get("Author")] * n)
+        columns["EntryID"].extend([p.get("EntryID")] * n)
+        for wa in warnings_advisories:
+            columns["「AreaForecastLocalM」コード"].append(wa.get("AreaCode"))
+            columns["気象情報／府県予報区・細分区域等"].append(wa.get("Area"))
+            columns["Kind"].append(wa.get("Kind"))
+            columns["Detail"].append(wa.get("Detail"))
+    df = pd.DataFrame(columns)
+    # 繰り返しの多い文字列列は構築直後にカテゴリ型にし、以降の集計・地図・キャッシュのハッシュ計算を整数コードで行う
+    for col in ("Title", "Author", "気象情報／府県予報区・細分区域等", "Kind"):
+        df[col] = df[col].astype("category")
+    count = len(df)
+
 
-    
-    df = pd.DataFrame(transformed_data_for_db)
-    
-    # (Colab ステップ4 の列名変更を反映)
-    df = df.rename(columns={
-        "Area": "気象情報／府県予報区・細分区域等",
-        "AreaCode": "「AreaForecastLocalM」コード"
-    })
-    
-    # 列順序を定義 (存在しない列は無視される)
-    target_columns_order = [
-        "ReportDateTime",
-        "Title",
-        "Author",
-        "「AreaForecastLocalM」コード",
-        "気象情報／府県予報区・細分区域等",
-        "Kind",
-        "Detail",
-        "EntryID"
-    ]
-    ordered_columns = [col for col in target_columns_order if col in df.columns]
-    df = df[ordered_columns]
-
-
-    csv_buffer_warnings = io.StringIO()
-    df.to_csv(csv_buffer_warnings, index=False, encoding="utf-8-sig")
     count_placeholder.success(f"{count} 件の警報・注意報データの読み込みが完了しました！")  # 完了メッセージ
     
     st.download_button(
         label="警報・注意報データ（生）を CSV でダウンロード",
-        data=csv_buffer_warnings.getvalue().encode("utf-8-sig"),  # BOM付きUTF-8
+        data=_csv_bytes(df),  # BOM付きUTF-8
         file_name=f"warnings_raw_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv",
         mime="text/csv"
     )
@@ -324,67 +575,43 @@ if parsed:
     st.markdown("---")
     st.markdown("### 🗺️ 警報・注意報 発令履歴マップ(mapbox)")
 
-    # 緯度・経度マッピング辞書（簡易版：主要都道府県・地域）
-    AREA_LAT_LON_MAP = {
-        "北海道": [43.06, 141.35], "札幌": [43.06, 141.35], "青森県": [40.82, 140.74],
-        "岩手県": [39.70, 141.15], "宮城県": [38.27, 140.87], "仙台": [38.27, 140.87],
-        "秋田県": [39.72, 140.10], "山形県": [38.24, 140.36], "福島県": [37.75, 140.47],
-        "茨城県": [36.34, 140.45], "栃木県": [36.57, 139.88], "群馬県": [36.39, 139.06],
-        "埼玉県": [35.86, 139.65], "千葉県": [35.61, 140.12], "東京都": [35.69, 139.69],
-        "千代田区": [35.69, 139.75], "伊豆諸島北部": [34.74, 139.40], "伊豆諸島南部": [33.11, 139.79],
-        "小笠原諸島": [26.65, 142.20], "神奈川県": [35.45, 139.64], "横浜": [35.45, 139.64],
-        "新潟県": [37.90, 139.02], "富山県": [36.70, 137.21], "石川県": [36.59, 136.63],
-        "福井県": [36.07, 136.22], "山梨県": [35.66, 138.57], "長野県": [36.65, 138.18],
-        "岐阜県": [35.42, 136.72], "静岡県": [34.98, 138.38], "愛知県": [35.18, 136.91],
-        "名古屋": [35.18, 136.91], "三重県": [34.73, 136.51], "滋賀県": [35.00, 135.87],
-        "京都府": [35.02, 135.76], "大阪府": [34.69, 135.50], "兵庫県": [34.69, 135.18],
-        "奈良県": [34.69, 135.83], "和歌山県": [34.23, 135.17], "鳥取県": [35.50, 134.24],
-        "島根県": [35.47, 133.05], "岡山県": [34.66, 133.93], "広島県": [34.40, 132.46],
-        "山口県": [34.19, 131.47], "徳島県": [34.07, 134.56], "香川県": [34.34, 134.04],
-        "愛媛県": [33.84, 132.77], "高知県": [33.56, 133.53], "福岡県": [33.61, 130.40],
-        "佐賀県": [33.26, 130.30], "長崎県": [32.75, 129.88], "熊本県": [32.80, 130.71],
-        "大分県": [33.24, 131.61], "宮崎県": [31.91, 131.42], "鹿児島県": [31.56, 130.56],
-        "沖縄県": [26.21, 127.68], "沖縄本島地方": [26.21, 127.68], "宮古島地方": [24.80, 125.28],
-        "八重山地方": [24.34, 124.16]
-        # ... 他の市町村コードを追加可能 ...
-    }
-
     if 'df' in locals() and df is not None and not df.empty:
         with st.spinner("地図データを準備しています..."):
-            df_map = df.copy()
-            
             # 'Area' 列 (列名変更後) をマップのキーと照合
             area_col_name = "気象情報／府県予報区・細分区域等" # Colabの列名
-            df_map['lat'] = df_map[area_col_name].map(lambda x: AREA_LAT_LON_MAP.get(x, [None, None])[0])
-            df_map['lon'] = df_map[area_col_name].map(lambda x: AREA_LAT_LON_MAP.get(x, [None, None])[1])
-            
+            # df 全体はコピーせず、地図に必要な列だけを取り出して結合する
+            # 行ごとの lambda ではなく、地域名をキーにした1回の結合で緯度・経度を付与し、
             # 緯度・経度が見つからなかったデータを削除
-            df_map.dropna(subset=['lat', 'lon'], inplace=True)
+            df_map = (
+                df[[area_col_name, 'Kind', 'Detail']]
+                .join(AREA_DF, on=area_col_name)
+                .dropna(subset=['lat', 'lon'])
+            )
 
             if not df_map.empty:
                 # 警報・注意報の種類（Kind）で色分けする
-                def get_color(kind_str):
-                    if "特別警報" in kind_str:
-                        return [255, 0, 255, 180] # 紫 (不透明度追加)
-                    elif "警報" in kind_str:
-                        return [255, 0, 0, 180] # 赤
-                    elif "注意報" in kind_str:
-                        return [255, 255, 0, 180] # 黄
-                    else:
-                        return [128, 128, 128, 180] # グレー
-                
-                df_map['color'] = df_map['Kind'].apply(get_color)
+                # (Kind の種類は数十程度なので、ユニーク値ごとに1回だけ判定し、カテゴリのコードで各行に展開)
+                # Kind は構築時にカテゴリ型にしているため、地図に残った種類だけに絞ってそのまま使う
+                kind_cat = df_map['Kind'].cat.remove_unused_categories()
+                kind_names = kind_cat.cat.categories.to_series()
+                color_index_for_kind = np.select(
+                    [
+                        kind_names.str.contains("特別警報", regex=False),
+                        kind_names.str.contains("警報", regex=False),
+                        kind_names.str.contains("注意報", regex=False),
+                    ],
+                    [0, 1, 2],
+                    default=3,
+                )
+                # 欠損の Kind（コード -1）は末尾に追加したグレーを参照する
+                color_index_for_kind = np.append(color_index_for_kind, 3)
+                df_map['color'] = KIND_COLORS[color_index_for_kind[kind_cat.cat.codes.to_numpy()]].tolist()
                 
                 # --- ▼▼▼ エラー修正箇所 ▼▼▼ ---
-                # ツールチップ用のテキストを作成 (Detailが長い場合に備えてラップ)
-                # (f-string のネストを回避するために文字列連結 + を使用)
-                df_map['tooltip'] = df_map.apply(
-                    lambda row: (
-                        f"{row[area_col_name]}: {row['Kind']}\n" + 
-                        ''.join([s + ('\n' if (i + 1) % 40 == 0 else '') for i, s in enumerate(str(row['Detail']))])
-                    ), 
-                    axis=1
-                )
+                # ツールチップ用のテキストを作成 (Detailが長い場合に備えて40文字ごとに改行)
+                # (行ごとの apply ではなく、列単位の文字列演算で作成)
+                detail_wrapped = df_map['Detail'].astype(str).str.replace(r"(?s)(.{40})", "\\1\n", regex=True)
+                df_map['tooltip'] = df_map[area_col_name].astype(str) + ": " + df_map['Kind'].astype(str) + "\n" + detail_wrapped
                 # --- ▲▲▲ エラー修正箇所 ▲▲▲ ---
 
 
@@ -421,7 +648,8 @@ if parsed:
                     tooltip=tooltip_html,
                 ))
                 
-                with st.expander("マップデータの詳細（緯度・経度が付与されたデータ）"):
+                # expander は閉じていても中身を送信するため、チェック時のみ DataFrame を描画
+                if st.checkbox("マップデータの詳細（緯度・経度が付与されたデータ）を表示", value=False):
                     st.dataframe(df_map[[area_col_name, 'Kind', 'lat', 'lon', 'Detail']])
 
             else:
@@ -441,43 +669,35 @@ if parsed:
     # dfが利用可能で空でないか確認します。
     if 'df' in locals() and df is not None and not df.empty:
         with st.spinner("ピボットテーブルを作成しています..."):
-            report_date_col_exists = False
+            report_date = None
             try:
                 # ReportDateTimeをdatetimeオブジェクトに変換し、日付のみを保持します。
-                df_pivot = df.copy() # 元のdfを変更しないようにコピー
-                df_pivot['ReportDateTime_cleaned'] = pd.to_datetime(df_pivot['ReportDateTime'], errors='coerce')
-                df_pivot['ReportDateTime_cleaned'] = df_pivot['ReportDateTime_cleaned'].dt.tz_convert(None) # タイムゾーン削除
-                df_pivot['ReportDate'] = df_pivot['ReportDateTime_cleaned'].dt.date # 日付のみ取得
-                report_date_col_exists = True
+                # dfはコピーせず、日付は単独のSeriesとしてgroupbyに渡す
+                report_date = to_report_date(df['ReportDateTime'])
             except Exception as e:
-                st.error(f"ReportDateTimeの変換エラー: {e}")
                 # 変換に失敗した場合、エラーを表示
-                df_pivot['ReportDate'] = pd.NaT 
+                st.error(f"ReportDateTimeの変換エラー: {e}")
 
             # ReportDateが正常に作成されたか確認
-            if report_date_col_exists and not df_pivot['ReportDate'].isnull().all():
+            if report_date is not None and not report_date.isnull().all():
                 
-                # Colab ステップ5 のインデックス列
-                manual_pivot_index_cols = ['ReportDate', 'Title', 'Author', '「AreaForecastLocalM」コード', '気象情報／府県予報区・細分区域等']
+                # Colab ステップ5 のインデックス列（ReportDate の後に続く列）
+                manual_pivot_index_cols = ['Title', 'Author', '「AreaForecastLocalM」コード', '気象情報／府県予報区・細分区域等']
                 
                 try:
-                    # 'Kind' 列を文字列型に変換 (unstackのため)
-                    df_pivot['Kind'] = df_pivot['Kind'].astype(str)
-
-                    # Colab ステップ5 の groupby().size().unstack() を使用
-                    manual_pivot_df = df_pivot.groupby(manual_pivot_index_cols + ['Kind']).size().unstack(fill_value=0)
+                    # Detail などピボットで使わない列はハッシュ計算の対象にしない
+                    manual_pivot_df = build_manual_pivot(df[manual_pivot_index_cols + ['Kind']], report_date, manual_pivot_index_cols)
 
                     st.success("各地域ごとの警報/注意報の発令状況（ピボットテーブル）が正常に作成されました。")
-                    st.dataframe(manual_pivot_df) # StreamlitでDataFrameを表示
+                    # ブラウザへ送るデータ量を抑えるため先頭のみ表示（ダウンロードは全件）
+                    if len(manual_pivot_df) > PIVOT_DISPLAY_MAX_ROWS:
+                        st.caption(f"表示は先頭{PIVOT_DISPLAY_MAX_ROWS}行のみ / 全{len(manual_pivot_df)}行")
+                    st.dataframe(manual_pivot_df.reset_index().head(PIVOT_DISPLAY_MAX_ROWS), width="stretch") # StreamlitでDataFrameを表示（高さは行数に合わせる）
 
                     # ピボTテーブルをCSVファイルに保存（ダウンロードボタン）
-                    csv_buffer_pivot = io.StringIO()
-                    # MultiIndexを維持したままCSVに保存
-                    manual_pivot_df.to_csv(csv_buffer_pivot, encoding='utf-8-sig') # BOM付きUTF-8
-                    
                     st.download_button(
                         label="地域別ピボットテーブルを CSV でダウンロード",
-                        data=csv_buffer_pivot.getvalue().encode("utf-8-sig"), # BOM付きUTF-8
+                        data=_csv_bytes(manual_pivot_df, index=True), # MultiIndexを維持したままCSVに保存（BOM付きUTF-8）
                         file_name=f"warnings_pivot_by_area_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv",
                         mime="text/csv"
                     )